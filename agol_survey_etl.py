@@ -1,11 +1,21 @@
-import polars, os, logging, requests, json
+import polars, os, io, logging, requests, msgspec
 import psycopg2 as pg
 from psycopg2 import sql
-from numpy import ndarray
+from psycopg2.pool import ThreadedConnectionPool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-from yaml import load, Loader
+from functools import lru_cache
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from yaml import load
 from log.logfilter import SensitiveFormatter
 
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
 logging.basicConfig(
     filename="log/agol_etl.log",
     encoding="utf-8",
@@ -29,44 +39,171 @@ user = os.getenv("kwb_dw_user")
 host = os.getenv("kwb_dw_host")
 password = os.getenv("kwb_dw_password")
 
+# Upper bound on surveys, AGOL pages and db connections handled at once
+MAX_WORKERS = 8
+
+# Sized so that page requests and the per-survey requests running
+# alongside them all fit in the connection pool. AGOL queries are read
+# only, so they're retried even though they're posted
+session = requests.Session()
+session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=MAX_WORKERS,
+        pool_maxsize=2 * MAX_WORKERS,
+        max_retries=Retry(total=3, backoff_factor=0.5, allowed_methods=None),
+    ),
+)
+page_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+POLARS_TYPES = {
+    "string": polars.String,
+    "int64": polars.Int64,
+    "float64": polars.Float64,
+}
+
+# Default maxRecordCount of hosted feature layers in AGOL, layers with a lower
+# maxRecordCount need page_size set in etl_variables.yaml
+PAGE_SIZE = 2000
+
+
+class Feature(msgspec.Struct):
+    """
+    A single feature of an AGOL query response. Attributes are kept as
+    the raw json object so polars can parse them natively.
+    """
+
+    attributes: msgspec.Raw
+
+
+class QueryResponse(msgspec.Struct):
+    """
+    AGOL query response, only the features are decoded. AGOL reports
+    failed queries as an error object in the body of a 200 response.
+    """
+
+    features: list[Feature] = []
+    exceededTransferLimit: bool = False
+    error: Optional[dict] = None
+
+
+class IdsResponse(msgspec.Struct):
+    """
+    AGOL returnIdsOnly response, the object ids of every record that
+    is paged over.
+    """
+
+    objectIds: Optional[list[int]] = None
+    error: Optional[dict] = None
+
+
+def query_agol_layer(
+    layer_params: dict, survey_params: dict, response_type: type
+) -> tuple:
+    """
+    This sends a single query to a survey layer in AGOL. Queries are
+    posted so long objectIds lists don't end up in the url.
+
+    Args:
+        layer_params: dict, query parameters sent to the layer url
+        survey_params: dict, dictionary of parameters used for specific survey query
+        response_type: type, msgspec struct the response is decoded into
+    Returns:
+        tuple, json response body as returned by AGOL and the decoded response
+    """
+    try:
+        layer_r = session.post(survey_params["url"], data=layer_params, timeout=(5, 60))
+    except requests.exceptions.RequestException as e:
+        logger.error("API request failed: %s", e)
+        raise
+    if layer_r.status_code != 200:
+        message = "Bad request - check %s url and debug (HTTP %s)" % (
+            survey_params["name"],
+            layer_r.status_code,
+        )
+        logger.error(message)
+        raise requests.exceptions.HTTPError(message, response=layer_r)
+
+    response = msgspec.json.decode(layer_r.content, type=response_type)
+    if response.error is not None:
+        message = "AGOL query for %s failed: %s" % (
+            survey_params["name"],
+            response.error.get("message"),
+        )
+        logger.error(message)
+        raise ValueError(message)
+    logger.info("Successfully queried %s data!", survey_params["name"])
+    return layer_r.content, response
+
 
-def query_agol_data(token: str, survey_params: dict, date_ran: str):
+def query_agol_data(token: str, survey_params: dict, date_ran: str) -> str:
     """
-    This queryies survey layers in AGOL and dumps the returned results
-    as a json.
+    This queryies survey layers in AGOL page by page, dumping each
+    returned page as a json and appending the feature attributes of
+    each page to a ndjson as it arrives. Pages are chunks of the object
+    ids returned up front, so records added or deleted mid run can't
+    shift pages.
 
     Args:
         token: str, API token as provided/generated by Esri
         survey_params: dict, dictionary of parameters used for specific survey query
         date_ran: str, date on which etl was ran
+    Returns:
+        attributes_path: str, path to ndjson of feature attributes
     """
-    layer_url = survey_params["url"]
-
     layer_params = {
-        "f": "pjson",
+        "f": "json",
         "token": token,
     }
-    try:
-        layer_r = requests.get(layer_url, layer_params)
-        if layer_r.status_code == 200:
-            logger.info("Successfully queried %s data!" % (survey_params["name"]))
-        else:
-            logging.exception(
-                "Bad request - check %s url and debug" % (survey_params["name"])
-            )
-    except requests.exceptions.RequestException as e:
-        logger.error(f"API request failed: {e}")
-    layer_json = layer_r.json()
-    data_file_name = "raw_data/%s_%s.json" % (survey_params["name"], date_ran)
-    with open(data_file_name, "w") as file:
-        json.dump(layer_json, file, indent=4)
-
+    _, ids = query_agol_layer(
+        {**layer_params, "returnIdsOnly": "true"}, survey_params, IdsResponse
+    )
+    object_ids = sorted(ids.objectIds or [])
+    page_size = survey_params.get("page_size", PAGE_SIZE)
+    page_ids = [
+        object_ids[start : start + page_size]
+        for start in range(0, len(object_ids), page_size)
+    ]
+
+    pages = page_executor.map(
+        lambda chunk: query_agol_layer(
+            {**layer_params, "objectIds": ",".join(map(str, chunk))},
+            survey_params,
+            QueryResponse,
+        ),
+        page_ids,
+    )
 
-def transform_agol_data(survey_params, date_ran) -> polars.DataFrame:
+    attributes_path = "processed_data/%s_%s.ndjson" % (survey_params["name"], date_ran)
+    with open(attributes_path, "wb") as attributes_file:
+        for page_number, (raw_page, page) in enumerate(pages):
+            data_file_name = "raw_data/%s_%s_%s.json" % (
+                survey_params["name"],
+                date_ran,
+                page_number,
+            )
+            with open(data_file_name, "wb") as file:
+                file.write(raw_page)
+            if page.exceededTransferLimit:
+                message = (
+                    "%s page_size of %s exceeds the layer's maxRecordCount, "
+                    "set a lower page_size in etl_variables.yaml."
+                    % (survey_params["name"], page_size)
+                )
+                logger.error(message)
+                raise ValueError(message)
+            for feature in page.features:
+                attributes_file.write(feature.attributes)
+                attributes_file.write(b"\n")
+    return attributes_path
+
+
+def transform_agol_data(attributes_path, survey_params, date_ran) -> str:
     """
     This transforms json data into parquets with correct data format.
 
     Args:
+        attributes_path: str, path to ndjson of feature attributes
         survey_params: dict, dictionary of parameters used for specific survey query
         date_ran: str, date on which etl was ran
     Returns:
@@ -74,71 +211,104 @@ def transform_agol_data(survey_params, date_ran) -> polars.DataFrame:
     """
     schema = build_schema(survey_params)
 
-    with open("raw_data/%s_%s.json" % (survey_params["name"], date_ran), "r") as file:
-        data = json.load(file)
-
-    df = (
-        polars.from_dicts(
-            [feature["attributes"] for feature in data["features"]], schema=schema
-        )
-        .with_columns(polars.from_epoch("date_collected", time_unit="ms"))
-        .cast({"date_collected": polars.Date})
-    )
     proccessed_data_path = ("processed_data/%s_%s.parquet") % (
         survey_params["name"],
         date_ran,
     )
-    df.write_parquet(proccessed_data_path)
-    return df
+    # Passing schema to read_ndjson nulls values of a mismatched json type,
+    # read the inferred types and cast strictly so they convert or raise
+    attributes = (
+        polars.read_ndjson(attributes_path, infer_schema_length=None)
+        if os.path.getsize(attributes_path)
+        else polars.DataFrame()
+    )
+    (
+        attributes.select(
+            [
+                (
+                    polars.col(col)
+                    if col in attributes.columns
+                    else polars.lit(None).alias(col)
+                )
+                for col in schema
+            ]
+        )
+        .cast(schema, strict=True)
+        .with_columns(
+            polars.from_epoch("date_collected", time_unit="ms").cast(polars.Date)
+        )
+        .write_parquet(
+            proccessed_data_path,
+            compression="zstd",
+            compression_level=3,
+            statistics=True,
+            row_group_size=128_000,
+        )
+    )
+    return proccessed_data_path
 
 
 def build_schema(survey_params: dict) -> dict:
     """
     Builds schema based on survey_params input in etl_varibales.yaml
     Args:
-        ssurvey_params: dict, dictionary of parameters used for specific survey query
+        survey_params: dict, dictionary of parameters used for specific survey query
     Returns:
         schema: dict, dictionary of colums with correct polars typing
     """
-    schema: dict = survey_params["json_schema"]
-    for key, value in schema.items():
-        if value == "string":
-            schema[key] = polars.String
-        elif value == "int64":
-            schema[key] = polars.Int64
-        elif value == "float64":
-            schema[key] = polars.Float64
-        else:
-            schema[key] = polars.String
-    return schema
+    return dict(build_schema_items(tuple(survey_params["json_schema"].items())))
 
 
-def get_pg_connection(db_name: str) -> pg.extensions.connection:
+@lru_cache(maxsize=None)
+def build_schema_items(json_schema: tuple) -> tuple:
     """
-    This tests a connection with a postgres database to ensure that
-    we're loading into a database that actually exists.
+    Maps the (column, type) pairs of a survey's json_schema to polars
+    types. The result is cached per schema and immutable, so every call
+    of build_schema still gets a fresh dict.
+    Args:
+        json_schema: tuple, (column, type) pairs of the survey's json_schema
+    Returns:
+        tuple, (column, polars type) pairs
+    """
+    return tuple(
+        (key, POLARS_TYPES.get(value, polars.String)) for key, value in json_schema
+    )
+
+
+def get_pg_pool(db_name: str, maxconn: int) -> ThreadedConnectionPool:
+    """
+    This opens a pool of connections with a postgres database to ensure
+    that we're loading into a database that actually exists. Connections
+    are reused across surveys instead of reconnecting for each load.
 
     Args:
         db_name: str, name of database to connect to.
+        maxconn: int, maximum number of connections kept in the pool
     Returns:
-        con: pg.extensions.connection, psycopg connection to pg database
+        con_pool: ThreadedConnectionPool, pool of psycopg connections to
+            pg database
+    Raises:
+        pg.OperationalError, if the database can't be connected to
     """
     try:
-        con = pg.connect(
-            "dbname=%s user=%s host=%s password=%s" % (db_name, user, host, password)
+        con_pool = ThreadedConnectionPool(
+            1,
+            maxconn,
+            "dbname=%s user=%s host=%s password=%s" % (db_name, user, host, password),
         )
-        con.autocommit = True
-        logging.info("Successfully connected to %s db" % (db_name))
-        return con
+        logging.info("Successfully connected to %s db", db_name)
+        return con_pool
 
     except pg.OperationalError as Error:
         logging.error(Error)
+        raise
 
 
 def check_table_exists(con: pg.extensions.connection, schema_name: str, table: str):
     """
     This tests a to ensure the table we'll be writing to exists in
-    the postgres schema provided.
+    the postgres schema provided. Only the catalog is checked, no table
+    data is read.
 
     Args:
         con: pg.extensions.connection, psycopg connection to pg
@@ -147,107 +317,190 @@ def check_table_exists(con: pg.extensions.connection, schema_name: str, table: s
         table_name: str, name of table
     """
     cur = con.cursor()
-    command = sql.SQL(
-        """
-        Select * from {schema_name}.{table} limit 1  
-        """
-    ).format(
-        schema_name=sql.Identifier(schema_name),
-        table=sql.Identifier(table),
+    cur.execute(
+        "SELECT to_regclass(%s) IS NOT NULL",
+        (sql.Identifier(schema_name, table).as_string(con),),
     )
-    try:
-        cur.execute(command)
-        if isinstance(cur.fetchall(), list):
-            logging.info("Table exists, continue with loading.")
-    except pg.OperationalError as Error:
-        logging.error(Error)
+    exists = cur.fetchone()[0]
+    cur.close()
+    if not exists:
+        message = "Table %s.%s does not exist, cannot load data." % (schema_name, table)
+        logging.error(message)
+        raise LookupError(message)
+    logging.info("Table exists, continue with loading.")
 
 
 def load_data_into_pg_warehouse(
-    data: polars.DataFrame, etl_yaml: dict, survey_params: dict
+    con_pool: ThreadedConnectionPool,
+    proccessed_data_path: str,
+    etl_yaml: dict,
+    survey_params: dict,
 ):
     """
     This loads data into the KWB data warehouse, hosted in a postgres db.
 
     Args:
-        data: polars.DataFrame, data to be loaded into warehouse
+        con_pool: ThreadedConnectionPool, pool of psycopg connections to
+            pg database
+        proccessed_data_path: str, path to parquet file to be loaded to db
         etl_yaml: dict, general variables for the etl process
         survey_params: dict, variables for specific surveys, such as
             rainfall or recharge surveys
     """
-    con = get_pg_connection(etl_yaml["db_name"])
-    check_table_exists(con, etl_yaml["schema_name"], survey_params["table_name"])
+    staging_query, copy_query, merge_query = build_load_queries(
+        schema_name=etl_yaml["schema_name"],
+        table=survey_params["table_name"],
+        col_names=tuple(survey_params["db_schema"].keys()),
+        prim_key=survey_params["prim_key"],
+        update_col=survey_params["update_col"],
+    )
+
+    csv_data = io.BytesIO()
+    polars.read_parquet(proccessed_data_path).write_csv(csv_data, include_header=False)
+    csv_data.seek(0)
+    con = con_pool.getconn()
     try:
-        cur = con.cursor()
-        for row in data.to_numpy():
-            query = build_load_query(row, etl_yaml, survey_params)
-            cur.execute(query)
+        check_table_exists(con, etl_yaml["schema_name"], survey_params["table_name"])
+        with con:
+            cur = con.cursor()
+            cur.execute(staging_query)
+            cur.copy_expert(copy_query, csv_data)
+            cur.execute(merge_query)
         cur.close()
-        con.close()
         logging.info(
-            "Data was successfully loaded to %s.%s.%s"
-            % (
-                etl_yaml["db_name"],
-                etl_yaml["schema_name"],
-                survey_params["table_name"],
-            )
+            "Data was successfully loaded to %s.%s.%s",
+            etl_yaml["db_name"],
+            etl_yaml["schema_name"],
+            survey_params["table_name"],
         )
     except pg.OperationalError as Error:
-        con.close()
         logging.error(Error)
+        raise
+    finally:
+        con_pool.putconn(con)
     return
 
 
-def build_load_query(
-    data: ndarray, etl_yaml: dict, survey_params: dict
-) -> pg.sql.Composed:
+@lru_cache(maxsize=None)
+def build_load_queries(
+    schema_name: str, table: str, col_names: tuple, prim_key: str, update_col: str
+) -> tuple:
     """
-    This loads data into the KWB data warehouse, hosted in a postgres db.
+    Builds the queries used to load data into the KWB data warehouse.
+    These only depend on the target table, so they're composed once per
+    table and reused.
 
     Args:
-        data: numpy.ndarray, row of data to be loaded
-        etl_yaml: dict, general variables for the etl process
-        survey_params: dict, variables for specific surveys, such as
-            rainfall or recharge surveys
+        schema_name: str, name of postgres schema
+        table: str, name of table
+        col_names: tuple, names of columns to be loaded
+        prim_key: str, primary key used to resolve conflicts
+        update_col: str, column updated on conflict
     Returns:
-        pg.sql.Composed, Upsert query used to load data
+        tuple, staging table, copy and upsert queries used to load data
     """
-    col_names = sql.SQL(", ").join(
-        sql.Identifier(col) for col in survey_params["db_schema"].keys()
+    query_params = dict(
+        schema_name=sql.Identifier(schema_name),
+        table=sql.Identifier(table),
+        staging=sql.Identifier("%s_staging" % (table)),
+        col_names=sql.SQL(", ").join(sql.Identifier(col) for col in col_names),
+        prim_key=sql.SQL(prim_key),
+        update_col=sql.Identifier(update_col),
     )
-    values = sql.SQL(" , ").join(sql.Literal(val) for val in data)
-    return sql.SQL(
+    staging_query = sql.SQL(
         """
-        INSERT INTO {schema_name}.{table} ({col_names}) VALUES ({values})
+        CREATE TEMP TABLE {staging} ON COMMIT DROP AS
+        SELECT {col_names} FROM {schema_name}.{table} WITH NO DATA
+        """
+    ).format(**query_params)
+    copy_query = sql.SQL(
+        """
+        COPY {staging} ({col_names}) FROM STDIN WITH (FORMAT CSV)
+        """
+    ).format(**query_params)
+    # Rows sharing a primary key can't be upserted by one statement, keep
+    # the last one copied (highest ctid) like row by row upserts did
+    merge_query = sql.SQL(
+        """
+        INSERT INTO {schema_name}.{table} ({col_names})
+        SELECT DISTINCT ON ({prim_key}) {col_names} FROM {staging}
+        ORDER BY {prim_key}, ctid DESC
         ON CONFLICT ({prim_key}) DO UPDATE SET {update_col} = Excluded.{update_col}, edited_on = current_timestamp
         """
-    ).format(
-        schema_name=sql.Identifier(etl_yaml["schema_name"]),
-        table=sql.Identifier(survey_params["table_name"]),
-        col_names=col_names,
-        values=values,
-        prim_key=sql.SQL(survey_params["prim_key"]),
-        update_col=sql.Identifier(survey_params["update_col"]),
+    ).format(**query_params)
+    return staging_query, copy_query, merge_query
+
+
+def run_survey_etl(
+    token: str,
+    con_pool: ThreadedConnectionPool,
+    etl_yaml: dict,
+    survey_params: dict,
+    date_ran: str,
+):
+    """
+    This runs the extract, transform and load steps for a single survey,
+    so that surveys can be processed independently of each other.
+
+    Args:
+        token: str, API token as provided/generated by Esri
+        con_pool: ThreadedConnectionPool, pool of psycopg connections to
+            pg database
+        etl_yaml: dict, general variables for the etl process
+        survey_params: dict, dictionary of parameters used for specific survey query
+        date_ran: str, date on which etl was ran
+    """
+    attributes_path = query_agol_data(
+        token=token, survey_params=survey_params, date_ran=date_ran
+    )
+
+    proccessed_data_path = transform_agol_data(
+        attributes_path=attributes_path,
+        survey_params=survey_params,
+        date_ran=date_ran,
+    )
+
+    load_data_into_pg_warehouse(
+        con_pool=con_pool,
+        proccessed_data_path=proccessed_data_path,
+        etl_yaml=etl_yaml,
+        survey_params=survey_params,
     )
 
 
 if __name__ == "__main__":
     date_ran = datetime.date(datetime.today())
-    logger.info(
-        "--------------- AGOL Survey ETL ran on %s ----------------" % (date_ran)
-    )
+    logger.info("--------------- AGOL Survey ETL ran on %s ----------------", date_ran)
 
     etl_yaml = load(open("yaml/etl_variables.yaml", "r"), Loader)
     token = etl_yaml["token"]
-    for survey in etl_yaml["surveys"]:
-        survey_params = etl_yaml["surveys"][survey]
-        query_agol_data(token=token, survey_params=survey_params, date_ran=date_ran)
-
-        proc_data = transform_agol_data(survey_params=survey_params, date_ran=date_ran)
-
-        load_data_into_pg_warehouse(
-            data=proc_data,
-            etl_yaml=etl_yaml,
-            survey_params=survey_params,
-        )
-    logger.info("Succesfully ran AGOL ETL.\n")
+    surveys = list(etl_yaml["surveys"].values())
+    workers = min(len(surveys), MAX_WORKERS) or 1
+    con_pool = get_pg_pool(etl_yaml["db_name"], maxconn=workers)
+    failed = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    run_survey_etl,
+                    token=token,
+                    con_pool=con_pool,
+                    etl_yaml=etl_yaml,
+                    survey_params=survey_params,
+                    date_ran=date_ran,
+                ): survey_params["name"]
+                for survey_params in surveys
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception("AGOL ETL failed for %s", futures[future])
+                    failed.append(futures[future])
+    finally:
+        con_pool.closeall()
+
+    if failed:
+        logger.error("AGOL ETL failed for %s.\n", ", ".join(failed))
+    else:
+        logger.info("Succesfully ran AGOL ETL.\n")
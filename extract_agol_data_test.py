@@ -1,6 +1,10 @@
 import requests
-import json
-from yaml import load, Loader
+from yaml import load
+
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
 
 if __name__ == "__main__":
     survey = ""
@@ -14,6 +18,5 @@ if __name__ == "__main__":
     }
 
     layer_r = requests.get(url, layer_params)
-    layer_json = layer_r.json()
-    with open("datatest.json", "w") as file:
-        json.dump(layer_json, file, indent=4)
+    with open("datatest.json", "wb") as file:
+        file.write(layer_r.content)